@@ -89,6 +89,11 @@ install_dependencies() {
     
     # Install Python packages
     pip3 install websockets asyncio --break-system-packages
+    # Optional speedups (server falls back to the standard library without them)
+    # Installed one at a time so a failed build of one does not skip the others
+    pip3 install orjson --break-system-packages || true
+    pip3 install msgpack --break-system-packages || true
+    pip3 install "uvloop; sys_platform != 'win32'" --break-system-packages || true
     
     print_success "Dependencies installed"
 }
@@ -1,11 +1,71 @@
 #!/usr/bin/env python3
-import asyncio, json, secrets, time, logging, os
+import asyncio, json, secrets, signal, socket, time, logging, os
 from collections import defaultdict
 from aiohttp import web, WSMsgType
 try:
     import aiohttp_cors
 except Exception:
     aiohttp_cors = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Hot-path JSON helpers: orjson when available, stdlib json otherwise.
+# _dumpb returns UTF-8 bytes ready to go on the wire.
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so callers can keep
+# catching the stdlib exception.
+if orjson is not None:
+    _dumpb = orjson.dumps
+    _loads = orjson.loads
+else:
+    # json.dumps() with non-default options builds a new encoder per call;
+    # reuse one configured for compact output instead. ensure_ascii keeps lone
+    # surrogates (which json.loads accepts from clients) escaped, so the
+    # encode below always succeeds.
+    _json_encoder = json.JSONEncoder(separators=(',', ':'))
+    def _dumpb(obj):
+        return _json_encoder.encode(obj).encode('ascii')
+    _loads = json.loads
+
+# Frequent fixed payloads, encoded once. Error frames only encode the message
+# string and splice it into a pre-built envelope.
+_PONG_FRAME = _dumpb({'type': 'pong'})
+_ERROR_FRAME_PREFIX = b'{"type":"error","message":'
+_ERROR_FRAME_SUFFIX = b'}'
+
+# Optional protocol features a client can opt into via 'set_capabilities'
+SUPPORTED_CAPABILITIES = ('binary_frames', 'batch_frames')
+
+# Per-client outbound queue: max pending payloads, and max payloads per write
+OUTBOX_MAXSIZE = 1000
+OUTBOX_BATCH_SIZE = 64
+
+# User IDs are USER_ID_LENGTH characters drawn from USER_ID_ALPHABET
+USER_ID_ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
+USER_ID_LENGTH = 6
+USER_ID_SPACE = len(USER_ID_ALPHABET) ** USER_ID_LENGTH
+
+# Seconds between background flushes of persisted state
+STATE_FLUSH_INTERVAL = 5
+
+# Default for read-only friend lookups, so they never insert into the defaultdict
+_EMPTY_FROZENSET = frozenset()
+
+def _set_tcp_option(sock, option, value):
+    """Best-effort TCP socket option; unsupported platforms/sockets are ignored"""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, option, value)
+    except (OSError, AttributeError):
+        pass
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -14,34 +74,75 @@ class XsukaxChatServer:
         self.users = {}  # user_id -> websocket
         self.user_data = {}  # user_id -> {websocket, public_key, last_seen}
         self.friends = defaultdict(set)  # user_id -> set of friend_user_ids
-        self.friend_requests = defaultdict(list)  # user_id -> list of pending requests
+        self.friend_requests = defaultdict(dict)  # user_id -> {sender_id: pending request}
         self.messages = defaultdict(list)  # conversation_id -> list of messages
+        self._convs_of = defaultdict(set)  # user_id -> set of conversation_ids they take part in
+        self._friends_payload_cache = {}  # user_id -> (encoded friends_list payload, friend count)
         self.key_status = {}  # user_id -> {private_key_loaded, public_key_loaded}
+        self.client_caps = {}  # websocket -> set of negotiated capabilities
+        self.outboxes = {}  # websocket -> (outbound queue, writer task)
         self.state_file = os.path.join(os.path.dirname(__file__), 'server_state.json')
+        # Preferred over state_file when msgpack is installed (faster to parse, smaller)
+        self.msgpack_state_file = os.path.join(os.path.dirname(__file__), 'server_state.msgpack')
+        self._state_dirty = False  # set by mutations, cleared by the background flusher
+        self._state_flusher_task = None
+        self._state_write = None  # in-flight executor write, awaited before the final save
+        self._now = time.time()  # wall-clock time of the message currently being handled
+        # action -> (handler, takes message data)
+        self._actions = {
+            'ping': (self.handle_ping, False),
+            'set_public_key': (self.set_public_key, True),
+            'set_key_status': (self.set_key_status, True),
+            'set_capabilities': (self.set_capabilities, True),
+            'resume_session': (self.resume_session, True),
+            'send_friend_request': (self.send_friend_request, True),
+            'respond_friend_request': (self.respond_friend_request, True),
+            'send_message': (self.send_message, True),
+            'get_friends': (self.get_friends, False),
+            'get_messages': (self.get_messages, True),
+            'get_key_status': (self.get_key_status, False),
+        }
 
         # Attempt to load persisted state (friends and public keys)
         self.load_state()
         
     def generate_user_id(self):
         """Generate unique 6-character ID"""
+        base = len(USER_ID_ALPHABET)
         while True:
-            user_id = ''.join(secrets.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789') for _ in range(6))
+            # One CSPRNG draw for the whole ID, then split it into digits
+            n = secrets.randbelow(USER_ID_SPACE)
+            chars = []
+            for _ in range(USER_ID_LENGTH):
+                n, d = divmod(n, base)
+                chars.append(USER_ID_ALPHABET[d])
+            user_id = ''.join(chars)
             if user_id not in self.users:
                 return user_id
                 
     def get_conversation_id(self, user1_id, user2_id):
         """Generate consistent conversation ID for two users"""
-        return '_'.join(sorted([user1_id, user2_id]))
+        if user1_id < user2_id:
+            return f"{user1_id}_{user2_id}"
+        return f"{user2_id}_{user1_id}"
         
     async def handle_websocket(self, request):
         ws = web.WebSocketResponse()
         await ws.prepare(request)
-        return await self.handle_client(ws)
+        sock = request.transport.get_extra_info('socket') if request.transport else None
+        if sock is not None:
+            # Send small frames immediately; batching is done with TCP_CORK instead
+            _set_tcp_option(sock, socket.TCP_NODELAY, 1)
+        return await self.handle_client(ws, sock)
         
-    async def handle_client(self, websocket):
+    async def handle_client(self, websocket, sock=None):
         user_id = None
         try:
             logging.info("New client connected")
+
+            # Outbound messages are queued and written by a dedicated task
+            queue = asyncio.Queue(maxsize=OUTBOX_MAXSIZE)
+            self.outboxes[websocket] = (queue, asyncio.create_task(self._writer(websocket, queue, sock)))
             
             # Generate and send unique ID
             user_id = self.generate_user_id()
@@ -56,11 +157,14 @@ class XsukaxChatServer:
                 'public_key_loaded': False
             }
             
-            await websocket.send_str(json.dumps({
+            await self.ws_send(user_id, {
                 'type': 'user_id_assigned', 
-                'user_id': user_id
-            }))
+                'user_id': user_id,
+                'capabilities': list(SUPPORTED_CAPABILITIES)
+            })
             logging.info(f"Assigned ID {user_id} to client")
+            # The ID may belong to persisted friendships whose online status just changed
+            self._invalidate_friends_payload(user_id)
 
             # Proactively send current friends list on connect
             try:
@@ -71,36 +175,26 @@ class XsukaxChatServer:
             async for msg in websocket:
                 if msg.type == WSMsgType.TEXT:
                     try:
-                        data = json.loads(msg.data)
+                        data = _loads(msg.data)
                         action = data.get('action')
                         logging.info(f"Action: {action} from {user_id}")
                         
+                        # Read the clock once per message; handlers use self._now
+                        self._now = time.time()
                         # Update last seen
                         if user_id in self.user_data:
-                            self.user_data[user_id]['last_seen'] = time.time()
+                            self.user_data[user_id]['last_seen'] = self._now
                         
-                        if action == 'ping':
-                            await self.handle_ping(user_id)
-                        elif action == 'set_public_key':
-                            await self.set_public_key(user_id, data)
-                        elif action == 'set_key_status':
-                            await self.set_key_status(user_id, data)
-                        elif action == 'resume_session':
-                            await self.resume_session(user_id, data)
-                        elif action == 'send_friend_request':
-                            await self.send_friend_request(user_id, data)
-                        elif action == 'respond_friend_request':
-                            await self.respond_friend_request(user_id, data)
-                        elif action == 'send_message':
-                            await self.send_message(user_id, data)
-                        elif action == 'get_friends':
-                            await self.get_friends(user_id)
-                        elif action == 'get_messages':
-                            await self.get_messages(user_id, data)
-                        elif action == 'get_key_status':
-                            await self.get_key_status(user_id)
-                        else:
+                        # Non-string actions (e.g. lists) are unhashable; report them as unknown
+                        entry = self._actions.get(action) if isinstance(action, str) else None
+                        if entry is None:
                             await self.send_error(user_id, f"Unknown action: {action}")
+                            continue
+                        handler, takes_data = entry
+                        if takes_data:
+                            await handler(user_id, data)
+                        else:
+                            await handler(user_id)
                     except json.JSONDecodeError:
                         logging.error(f"Invalid JSON from {user_id}")
                         await self.send_error(user_id, "Invalid JSON format")
@@ -117,22 +211,43 @@ class XsukaxChatServer:
         except Exception as e:
             logging.error(f"Connection error for {user_id}: {e}")
         finally:
+            outbox = self.outboxes.pop(websocket, None)
+            if outbox:
+                outbox[1].cancel()
+            self.client_caps.pop(websocket, None)
             if user_id:
                 await self.cleanup_user(user_id)
                 
     def load_state(self):
         """Load persisted friends and public keys from disk."""
+        if msgpack is None and os.path.exists(self.msgpack_state_file):
+            # After migration the JSON file is no longer updated; loading it
+            # and flushing over it would silently drop newer state
+            message = (f"{self.msgpack_state_file} exists but msgpack is not installed; "
+                       f"refusing to fall back to stale {self.state_file}")
+            logging.error(message)
+            raise RuntimeError(message)
         try:
-            if not os.path.exists(self.state_file):
+            if msgpack is not None and os.path.exists(self.msgpack_state_file):
+                path = self.msgpack_state_file
+                with open(path, 'rb') as f:
+                    data = msgpack.unpackb(f.read(), raw=False)
+            elif os.path.exists(self.state_file):
+                path = self.state_file
+                with open(path, 'rb') as f:
+                    data = _loads(f.read())
+                if msgpack is not None:
+                    # Migrate to the msgpack file on the next flush
+                    self._state_dirty = True
+            else:
                 return
-            with open(self.state_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            now = time.time()
             # Restore public keys into user_data (websocket will be set on connect)
             for uid, pub in data.get('user_public_keys', {}).items():
                 self.user_data[uid] = {
                     'websocket': None,
                     'public_key': pub,
-                    'last_seen': time.time()
+                    'last_seen': now
                 }
                 self.key_status[uid] = {
                     'private_key_loaded': False,
@@ -141,26 +256,85 @@ class XsukaxChatServer:
             # Restore friends map
             friends_map = data.get('friends', {})
             self.friends = defaultdict(set, {uid: set(lst) for uid, lst in friends_map.items()})
-            logging.info(f"Loaded state: {len(self.user_data)} users, {len(self.friends)} friend lists")
+            logging.info(f"Loaded state from {path}: {len(self.user_data)} users, {len(self.friends)} friend lists")
         except Exception as e:
             logging.error(f"Failed to load state: {e}")
 
     def save_state(self):
         """Persist friends and public keys to disk."""
         try:
-            data = {
-                'user_public_keys': {uid: info.get('public_key') for uid, info in self.user_data.items() if info.get('public_key')},
-                'friends': {uid: sorted(list(map(str, fset))) for uid, fset in self.friends.items() if fset}
-            }
-            with open(self.state_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, indent=2)
+            self._write_state(self._state_snapshot())
+            self._state_dirty = False
         except Exception as e:
             logging.error(f"Failed to save state: {e}")
 
+    def _state_snapshot(self):
+        """Copy the persisted parts of the state (runs on the event loop)."""
+        return {
+            'user_public_keys': {uid: info.get('public_key') for uid, info in self.user_data.items() if info.get('public_key')},
+            'friends': {uid: sorted(list(map(str, fset))) for uid, fset in self.friends.items() if fset}
+        }
+
+    def _write_state(self, data):
+        """Encode a state snapshot and atomically replace the state file."""
+        if msgpack is not None:
+            path = self.msgpack_state_file
+            encoded = msgpack.packb(data, use_bin_type=True)
+        elif orjson is not None:
+            path = self.state_file
+            encoded = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+        else:
+            path = self.state_file
+            encoded = json.dumps(data, indent=2).encode('utf-8')
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(encoded)
+        os.replace(tmp_file, path)
+
+    async def _state_flusher(self):
+        """Periodically write state to disk off the event loop if it changed."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            if not self._state_dirty:
+                continue
+            self._state_dirty = False
+            self._state_write = loop.run_in_executor(None, self._write_state, self._state_snapshot())
+            try:
+                # Shielded so cancelling the flusher leaves the write for
+                # stop_background_tasks to await
+                await asyncio.shield(self._state_write)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._state_dirty = True
+                logging.error(f"Failed to save state: {e}")
+            self._state_write = None
+
+    async def start_background_tasks(self, app):
+        self._state_flusher_task = asyncio.create_task(self._state_flusher())
+
+    async def stop_background_tasks(self, app):
+        if self._state_flusher_task:
+            self._state_flusher_task.cancel()
+            self._state_flusher_task = None
+        # Let a write already running in the executor finish before writing
+        # the same temp file from here
+        if self._state_write is not None:
+            try:
+                await self._state_write
+            except Exception as e:
+                self._state_dirty = True
+                logging.error(f"Failed to save state: {e}")
+            self._state_write = None
+        # Flush anything changed since the last periodic write
+        if self._state_dirty:
+            self.save_state()
+
     async def handle_ping(self, user_id):
         """Handle ping request"""
         try:
-            await self.ws_send(user_id, {'type': 'pong'})
+            await self.ws_send(user_id, _PONG_FRAME)
         except Exception as e:
             logging.error(f"Error sending pong to {user_id}: {e}")
                 
@@ -168,10 +342,7 @@ class XsukaxChatServer:
         """Send error message to user"""
         try:
             if user_id in self.users:
-                await self.ws_send(user_id, {
-                    'type': 'error', 
-                    'message': message
-                })
+                await self.ws_send(user_id, _ERROR_FRAME_PREFIX + _dumpb(message) + _ERROR_FRAME_SUFFIX)
         except Exception as e:
             logging.error(f"Error sending error message to {user_id}: {e}")
             
@@ -182,12 +353,17 @@ class XsukaxChatServer:
             if not public_key:
                 await self.send_error(user_id, "Public key is required")
                 return
+            # Stored, persisted and re-sent to friends, so it must re-encode
+            if not isinstance(public_key, str):
+                await self.send_error(user_id, "Public key must be a string")
+                return
                 
             if user_id in self.user_data:
                 self.user_data[user_id]['public_key'] = public_key
                 self.key_status[user_id]['public_key_loaded'] = True
                 # Persist change
-                self.save_state()
+                self._state_dirty = True
+                self._invalidate_friends_payload(user_id)
                 
                 response = {
                     'type': 'public_key_set', 
@@ -198,17 +374,19 @@ class XsukaxChatServer:
 
                 # Notify all friends that this user's public key is available/updated
                 if user_id in self.friends:
-                    notification = {
+                    # Encode once; every friend gets the same bytes
+                    notification = _dumpb({
                         'type': 'friend_key_updated',
                         'friend_id': user_id,
                         'friend_public_key': public_key
-                    }
-                    for fid in list(self.friends[user_id]):
-                        if fid in self.users:
-                            try:
-                                await self.ws_send(fid, notification)
-                            except Exception as e:
-                                logging.error(f"Error notifying friend {fid} of key update for {user_id}: {e}")
+                    })
+                    # Online friends via a single set intersection; sends are queued
+                    # per connection, so there is nothing to gather concurrently
+                    for fid in self.friends[user_id] & self.users.keys():
+                        try:
+                            await self.send_to_ws(self.users[fid], notification)
+                        except Exception as e:
+                            logging.error(f"Error notifying friend {fid} of key update for {user_id}: {e}")
 
                 logging.info(f"Public key set for {user_id}")
             else:
@@ -220,8 +398,8 @@ class XsukaxChatServer:
     async def set_key_status(self, user_id, data):
         """Update user's key loading status"""
         try:
-            private_loaded = data.get('private_key_loaded', False)
-            public_loaded = data.get('public_key_loaded', False)
+            private_loaded = bool(data.get('private_key_loaded', False))
+            public_loaded = bool(data.get('public_key_loaded', False))
             
             if user_id in self.key_status:
                 self.key_status[user_id]['private_key_loaded'] = private_loaded
@@ -236,6 +414,22 @@ class XsukaxChatServer:
         except Exception as e:
             logging.error(f"Error updating key status for {user_id}: {e}")
             
+    async def set_capabilities(self, user_id, data):
+        """Record optional protocol features supported by the client"""
+        try:
+            ws = self.users.get(user_id)
+            if not ws:
+                return
+            requested = data.get('capabilities') or []
+            caps = {c for c in SUPPORTED_CAPABILITIES if c in requested}
+            self.client_caps[ws] = caps
+            await self.ws_send(user_id, {
+                'type': 'capabilities_set',
+                'capabilities': sorted(caps)
+            })
+        except Exception as e:
+            logging.error(f"Error setting capabilities for {user_id}: {e}")
+
     async def get_key_status(self, user_id):
         """Get user's key status"""
         try:
@@ -247,7 +441,7 @@ class XsukaxChatServer:
                 'type': 'key_status',
                 'key_status': status
             }
-            await self.users[user_id].send(json.dumps(response))
+            await self.ws_send(user_id, response)
         except Exception as e:
             logging.error(f"Error getting key status for {user_id}: {e}")
             
@@ -268,23 +462,21 @@ class XsukaxChatServer:
                 await self.send_error(sender_id, "Cannot add yourself as friend")
                 return
                 
-            if target_id in self.friends[sender_id]:
+            if target_id in self.friends.get(sender_id, _EMPTY_FROZENSET):
                 await self.send_error(sender_id, "Already friends with this user")
                 return
                 
             # Check if request already exists
-            existing_requests = [req for req in self.friend_requests[target_id] 
-                               if req['sender_id'] == sender_id]
-            if existing_requests:
+            if sender_id in self.friend_requests[target_id]:
                 await self.send_error(sender_id, "Friend request already sent")
                 return
                 
             # Add friend request
             request_data = {
                 'sender_id': sender_id, 
-                'timestamp': time.time()
+                'timestamp': self._now
             }
-            self.friend_requests[target_id].append(request_data)
+            self.friend_requests[target_id][sender_id] = request_data
             
             # Notify target user
             if target_id in self.users:
@@ -317,11 +509,7 @@ class XsukaxChatServer:
                 return
             
             # Remove request
-            original_count = len(self.friend_requests[user_id])
-            self.friend_requests[user_id] = [req for req in self.friend_requests[user_id] 
-                                           if req['sender_id'] != sender_id]
-            
-            if len(self.friend_requests[user_id]) == original_count:
+            if self.friend_requests[user_id].pop(sender_id, None) is None:
                 await self.send_error(user_id, "Friend request not found")
                 return
             
@@ -329,6 +517,8 @@ class XsukaxChatServer:
                 # Add as friends
                 self.friends[user_id].add(sender_id)
                 self.friends[sender_id].add(user_id)
+                self._invalidate_friends_payload(user_id)
+                self._invalidate_friends_payload(sender_id)
                 
                 # Notify both users
                 response_to_accepter = {
@@ -349,7 +539,7 @@ class XsukaxChatServer:
                 logging.info(f"Friend request accepted: {sender_id} and {user_id} are now friends")
 
                 # Persist new friendship
-                self.save_state()
+                self._state_dirty = True
 
                 # Proactively send updated friends list to both users
                 try:
@@ -389,8 +579,14 @@ class XsukaxChatServer:
             if not encrypted_message:
                 await self.send_error(sender_id, "Encrypted message is required")
                 return
+
+            # Armored PGP text; anything else (e.g. deeply nested JSON) may not
+            # re-encode and would poison the stored conversation
+            if not isinstance(encrypted_message, str):
+                await self.send_error(sender_id, "Encrypted message must be a string")
+                return
             
-            if target_id not in self.friends[sender_id]:
+            if target_id not in self.friends.get(sender_id, _EMPTY_FROZENSET):
                 await self.send_error(sender_id, "Not friends with this user")
                 return
                 
@@ -399,10 +595,12 @@ class XsukaxChatServer:
                 'sender_id': sender_id,
                 'target_id': target_id,
                 'encrypted_message': encrypted_message,
-                'timestamp': time.time()
+                'timestamp': self._now
             }
             
             self.messages[conversation_id].append(message_data)
+            self._convs_of[sender_id].add(conversation_id)
+            self._convs_of[target_id].add(conversation_id)
             
             # Send to both users
             notification = {
@@ -428,22 +626,27 @@ class XsukaxChatServer:
     async def get_friends(self, user_id):
         """Get user's friends list"""
         try:
-            friends_data = []
-            for friend_id in self.friends[user_id]:
-                friend_info = {
-                    'user_id': friend_id,
-                    'public_key': self.user_data.get(friend_id, {}).get('public_key'),
-                    'last_seen': self.user_data.get(friend_id, {}).get('last_seen'),
-                    'online': friend_id in self.users
+            cached = self._friends_payload_cache.get(user_id)
+            if cached is None:
+                friends_data = []
+                for friend_id in self.friends.get(user_id, _EMPTY_FROZENSET):
+                    friend_info = {
+                        'user_id': friend_id,
+                        'public_key': self.user_data.get(friend_id, {}).get('public_key'),
+                        'last_seen': self.user_data.get(friend_id, {}).get('last_seen'),
+                        'online': friend_id in self.users
+                    }
+                    friends_data.append(friend_info)
+
+                response = {
+                    'type': 'friends_list', 
+                    'friends': friends_data
                 }
-                friends_data.append(friend_info)
-                
-            response = {
-                'type': 'friends_list', 
-                'friends': friends_data
-            }
-            await self.ws_send(user_id, response)
-            logging.info(f"Friends list sent to {user_id} ({len(friends_data)} friends)")
+                cached = (_dumpb(response), len(friends_data))
+                self._friends_payload_cache[user_id] = cached
+            payload, friend_count = cached
+            await self.ws_send(user_id, payload)
+            logging.info(f"Friends list sent to {user_id} ({friend_count} friends)")
             
         except Exception as e:
             logging.error(f"Error getting friends for {user_id}: {e}")
@@ -458,7 +661,7 @@ class XsukaxChatServer:
                 await self.send_error(user_id, "Target user ID is required")
                 return
                 
-            if target_id not in self.friends[user_id]:
+            if target_id not in self.friends.get(user_id, _EMPTY_FROZENSET):
                 await self.send_error(user_id, "Not friends with this user")
                 return
                 
@@ -489,10 +692,10 @@ class XsukaxChatServer:
             # If already on requested ID, confirm
             if requested_id == current_id:
                 if current_id in self.users:
-                    await self.users[current_id].send(json.dumps({
+                    await self.ws_send(current_id, {
                         'type': 'user_id_assigned',
                         'user_id': current_id
-                    }))
+                    })
                 return
 
             # Prevent taking an ID that's actively in use
@@ -506,10 +709,10 @@ class XsukaxChatServer:
                 if requested_id in self.user_data:
                     ws = self.users.get(requested_id) or self.user_data[requested_id].get('websocket')
                     if ws:
-                        await ws.send_str(json.dumps({
+                        await self.send_to_ws(ws, {
                             'type': 'user_id_assigned',
                             'user_id': requested_id
-                        }))
+                        })
                     return
                 # Otherwise nothing to do
                 await self.send_error(current_id, "Current session not found")
@@ -521,12 +724,15 @@ class XsukaxChatServer:
                 self.users[requested_id] = websocket
                 # Update last seen and websocket reference
                 self.user_data[requested_id]['websocket'] = websocket
-                self.user_data[requested_id]['last_seen'] = time.time()
+                self.user_data[requested_id]['last_seen'] = self._now
 
                 # Move key_status if current_id had any temp entry
                 if current_id in self.key_status and requested_id not in self.key_status:
                     self.key_status[requested_id] = self.key_status[current_id]
 
+                # Peers' cached lists show current_id online; drop them while
+                # current_id's friend set is still available
+                self._invalidate_friends_payload(current_id)
                 # Clean up current_id temporary allocations
                 if current_id in self.users:
                     del self.users[current_id]
@@ -543,9 +749,9 @@ class XsukaxChatServer:
                 # Adopt the requested ID by renaming current temp ID to the requested one
                 self.users[requested_id] = websocket
                 # Move user_data
-                self.user_data[requested_id] = self.user_data.get(current_id, {'websocket': websocket, 'public_key': None, 'last_seen': time.time()})
+                self.user_data[requested_id] = self.user_data.get(current_id, {'websocket': websocket, 'public_key': None, 'last_seen': self._now})
                 self.user_data[requested_id]['websocket'] = websocket
-                self.user_data[requested_id]['last_seen'] = time.time()
+                self.user_data[requested_id]['last_seen'] = self._now
                 # Move key status
                 if current_id in self.key_status:
                     self.key_status[requested_id] = self.key_status[current_id]
@@ -557,29 +763,33 @@ class XsukaxChatServer:
                     self.friends[requested_id] |= current_set
                 elif current_set:
                     self.friends[requested_id] = current_set
-                # Update other users' friend sets that referenced current_id
-                for uid, fset in self.friends.items():
-                    if current_id in fset:
+                # Update other users' friend sets that referenced current_id.
+                # Friendships are always added in both directions, so only
+                # current_id's own friends can reference it.
+                for peer in current_set:
+                    fset = self.friends.get(peer)
+                    if fset and current_id in fset:
                         fset.discard(current_id)
                         fset.add(requested_id)
-                # Move friend requests list
+                # Move pending friend requests
                 if current_id in self.friend_requests:
                     self.friend_requests[requested_id] = self.friend_requests[current_id]
                 # Migrate message conversation IDs containing current_id
                 try:
-                    to_move = []
-                    for conv_id in list(self.messages.keys()):
-                        if current_id in conv_id.split('_'):
-                            # Determine the other participant
-                            parts = conv_id.split('_')
-                            other = parts[0] if parts[1] == current_id else parts[1]
-                            new_conv = self.get_conversation_id(requested_id, other)
-                            to_move.append((conv_id, new_conv))
-                    for old_c, new_c in to_move:
-                        if new_c not in self.messages:
-                            self.messages[new_c] = []
-                        self.messages[new_c].extend(self.messages[old_c])
-                        del self.messages[old_c]
+                    for old_c in self._convs_of.pop(current_id, set()):
+                        # Determine the other participant
+                        parts = old_c.split('_')
+                        other = parts[0] if parts[1] == current_id else parts[1]
+                        new_c = self.get_conversation_id(requested_id, other)
+                        if old_c in self.messages:
+                            if new_c not in self.messages:
+                                self.messages[new_c] = []
+                            self.messages[new_c].extend(self.messages[old_c])
+                            del self.messages[old_c]
+                        self._convs_of[requested_id].add(new_c)
+                        other_convs = self._convs_of[other]
+                        other_convs.discard(old_c)
+                        other_convs.add(new_c)
                 except Exception:
                     pass
                 # Clean up current_id allocations
@@ -594,18 +804,22 @@ class XsukaxChatServer:
                 if current_id in self.friend_requests:
                     del self.friend_requests[current_id]
 
+            # Friend sets and online status changed for both IDs
+            self._friends_payload_cache.pop(current_id, None)
+            self._invalidate_friends_payload(requested_id)
+
             # Notify client of resumed/adopted ID
-            await websocket.send_str(json.dumps({
+            await self.send_to_ws(websocket, {
                 'type': 'user_id_assigned',
                 'user_id': requested_id
-            }))
+            })
             # Also push current friends list after resume/adopt
             try:
                 await self.get_friends(requested_id)
             except Exception:
                 pass
             # Persist after adoption in case mappings changed
-            self.save_state()
+            self._state_dirty = True
             logging.info(f"Session resumed/adopted: {current_id} -> {requested_id}")
             return
 
@@ -614,17 +828,85 @@ class XsukaxChatServer:
             await self.send_error(current_id, f"Failed to resume session: {str(e)}")
 
     async def ws_send(self, user_id, payload):
+        """Send a dict, str or pre-encoded JSON bytes payload to a user"""
         try:
             ws = self.users.get(user_id)
             if not ws:
                 return
-            if isinstance(payload, str):
-                await ws.send_str(payload)
-            else:
-                await ws.send_str(json.dumps(payload))
+            await self.send_to_ws(ws, payload)
         except Exception as e:
             logging.error(f"Error sending to {user_id}: {e}")
 
+    async def send_to_ws(self, ws, payload):
+        """Queue a payload (dict, str or pre-encoded bytes) for a websocket.
+
+        The payload is encoded immediately so later mutations of shared state
+        do not leak into it; the connection's writer task does the actual send.
+        """
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        elif not isinstance(payload, bytes):
+            payload = _dumpb(payload)
+        outbox = self.outboxes.get(ws)
+        if outbox is None:
+            await self._write_frames(ws, [payload])
+            return
+        try:
+            outbox[0].put_nowait(payload)
+        except asyncio.QueueFull:
+            logging.error("Outbound queue full, dropping message")
+
+    async def _writer(self, ws, queue, sock=None):
+        """Drain a client's outbound queue, writing queued frames in batches.
+
+        On Linux, when a batch goes out as several frames (clients without
+        'batch_frames'), it is written with TCP_CORK set so the kernel
+        coalesces them into as few packets as possible.
+        """
+        can_cork = sock is not None and hasattr(socket, 'TCP_CORK')
+        while True:
+            frames = [await queue.get()]
+            while len(frames) < OUTBOX_BATCH_SIZE:
+                try:
+                    frames.append(queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            # batch_frames clients get the whole batch as one frame (see
+            # _write_frames), so there is nothing for the kernel to coalesce
+            cork = (can_cork and len(frames) > 1
+                    and 'batch_frames' not in self.client_caps.get(ws, ()))
+            if cork:
+                _set_tcp_option(sock, socket.TCP_CORK, 1)
+            try:
+                await self._write_frames(ws, frames)
+            except Exception as e:
+                logging.error(f"Error writing to websocket: {e}")
+            finally:
+                if cork:
+                    _set_tcp_option(sock, socket.TCP_CORK, 0)
+
+    async def _write_frames(self, ws, frames):
+        """Write encoded JSON frames using the client's negotiated capabilities.
+
+        'batch_frames' clients get several payloads as one JSON array frame;
+        'binary_frames' clients get binary frames, skipping the str round-trip.
+        """
+        caps = self.client_caps.get(ws, ())
+        if len(frames) > 1 and 'batch_frames' in caps:
+            frames = [b'[' + b','.join(frames) + b']']
+        if 'binary_frames' in caps:
+            for frame in frames:
+                await ws.send_bytes(frame)
+        else:
+            for frame in frames:
+                await ws.send_str(frame.decode('utf-8'))
+
+    def _invalidate_friends_payload(self, user_id):
+        """Drop cached friends lists that show user_id's key or online status"""
+        self._friends_payload_cache.pop(user_id, None)
+        for fid in self.friends.get(user_id, ()):
+            self._friends_payload_cache.pop(fid, None)
+
     async def cleanup_user(self, user_id):
         """Clean up user data when disconnecting"""
         try:
@@ -633,6 +915,7 @@ class XsukaxChatServer:
             if user_id in self.user_data:
                 # Keep user data for offline access, just update last seen
                 self.user_data[user_id]['last_seen'] = time.time()
+            self._invalidate_friends_payload(user_id)
             logging.info(f"Cleaned up user {user_id}")
         except Exception as e:
             logging.error(f"Error cleaning up user {user_id}: {e}")
@@ -651,6 +934,8 @@ async def main():
     
     # Create aiohttp app
     app = web.Application()
+    app.on_startup.append(server.start_background_tasks)
+    app.on_cleanup.append(server.stop_background_tasks)
     
     # Optional CORS support (if aiohttp_cors available)
     cors = None
@@ -683,23 +968,39 @@ async def main():
     logging.info("  - Message persistence")
     logging.info("  - Connection health monitoring")
     
+    runner = None
     try:
         runner = web.AppRunner(app)
         await runner.setup()
         site = web.TCPSite(runner, host, port)
         await site.start()
         logging.info("✓ xsukax Chat Server is running and accepting connections")
-        
-        # Keep server running
-        await asyncio.Future()
+
+        # Keep server running until SIGTERM (systemd/Render stop) or Ctrl+C
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, lambda: stop.done() or stop.set_result(None))
+        except NotImplementedError:
+            pass  # e.g. Windows; only Ctrl+C is handled there
+        await stop
+        logging.info("Server shutdown requested (SIGTERM)")
         
     except KeyboardInterrupt:
         logging.info("Server shutdown requested by user")
     except Exception as e:
         logging.error(f"Server startup error: {e}")
         raise
+    finally:
+        # Runs the on_cleanup hooks, which flush pending state
+        if runner is not None:
+            await runner.cleanup()
 
 if __name__ == "__main__":
+    # Use the libuv-based event loop when available; aiohttp runs on whichever
+    # loop policy is active, so nothing else needs to change.
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     try:
         asyncio.run(main())
     except KeyboardInterrupt: